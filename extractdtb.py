@@ -1,70 +1,291 @@
 #!/usr/bin/env python3
 
 import argparse
+import mmap
 import os
 import re
+import struct
 import subprocess
 import sys
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    # pylibfdt из пакета dtc: читает свойства без запуска dtc
+    import libfdt
+except ImportError:
+    libfdt = None
 
 # Магический заголовок DTB
 DTB_HEADER = b"\xd0\x0d\xfe\xed"
 
-def get_readable_name(dtb_path):
+# Магии Android boot-образов (заголовки описаны в bootimg.h AOSP)
+BOOT_MAGIC = b"ANDROID!"
+VENDOR_BOOT_MAGIC = b"VNDRBOOT"
+# Магия заголовка ARM64 Image (смещение 0x38)
+ARM64_IMAGE_MAGIC = b"ARM\x64"
+
+# Сколько байт с начала файла смотрим при определении формата
+HEAD_SIZE = 4096
+
+# Токены структурного блока FDT
+FDT_BEGIN_NODE = 1
+FDT_END_NODE = 2
+FDT_PROP = 3
+FDT_NOP = 4
+FDT_END = 9
+
+# Регулярки для разбора вывода dtc компилируются один раз
+_COMPAT_RE = re.compile(r'compatible\s*=\s*"(.*?)"')
+_DESC_RE = re.compile(r'description\s*=\s*"(.*?)"')
+
+def _first_string(value):
+    """Первая строка из stringlist-свойства (байты с разделителем \\0)."""
+    return bytes(value).split(b"\0", 1)[0].decode("utf-8", errors="replace")
+
+def _find_prop_libfdt(fdt, name):
     """
-    Запускает dtc, читает dts и формирует имя файла по схеме:
+    Ищет первое вхождение свойства в порядке обхода дерева
+    (тот же порядок, что и в выводе dtc): сначала корень, затем дочерние узлы.
+    """
+    node = 0
+    depth = 0
+    while node >= 0:
+        try:
+            return _first_string(fdt.getprop(node, name))
+        except libfdt.FdtException:
+            pass
+        node, depth = fdt.next_node(node, depth, (libfdt.NOTFOUND,))
+    return None
+
+def _read_props_libfdt(blob):
+    """Читает compatible и description прямо из байтов DTB через libfdt."""
+    fdt = libfdt.Fdt(bytes(blob))
+    return _find_prop_libfdt(fdt, "compatible"), _find_prop_libfdt(fdt, "description")
+
+def _read_props_raw(blob, names=("compatible", "description")):
+    """
+    Разбирает структурный блок FDT прямо из байтов (без libfdt и dtc).
+    Значения свойств и их имена лежат в разных блоках DTB, поэтому
+    искать "compatible = ..." регуляркой по сырым байтам нельзя - идем по токенам.
+    Возвращает значения в порядке names (первое вхождение в порядке обхода дерева).
+    """
+    blob = bytes(blob)
+    if len(blob) < 40:
+        raise ValueError("DTB слишком короткий")
+
+    (magic, totalsize, off_struct, off_strings, off_rsvmap, version, _, _,
+     size_strings, size_struct) = struct.unpack_from(">10I", blob)
+    # Те же проверки, что в fdt_check_header: случайное вхождение магии
+    # внутри ядра не должно сойти за пустой DTB
+    # size_dt_struct есть только с версии 17; в v16 блок struct ограничен totalsize
+    if version < 17:
+        size_struct = 0
+    if (magic != struct.unpack(">I", DTB_HEADER)[0]
+            or version < 16
+            or not 40 <= totalsize <= len(blob)
+            or not 40 <= off_rsvmap < totalsize
+            or size_struct > totalsize or size_strings > totalsize
+            or not 40 <= off_struct <= totalsize - size_struct
+            or not 40 <= off_strings <= totalsize - size_strings):
+        raise ValueError("Некорректный заголовок DTB")
+
+    found = dict.fromkeys(names)
+    pos = off_struct
+    struct_end = off_struct + size_struct if version >= 17 else totalsize
+    while pos + 4 <= struct_end:
+        token = struct.unpack_from(">I", blob, pos)[0]
+        pos += 4
+        if token == FDT_BEGIN_NODE:
+            name_end = blob.index(b"\0", pos)
+            pos = (name_end + 4) & ~3
+        elif token == FDT_PROP:
+            length, nameoff = struct.unpack_from(">II", blob, pos)
+            pos += 8
+            if nameoff >= size_strings:
+                raise ValueError("Некорректное смещение имени свойства")
+            name_start = off_strings + nameoff
+            name = blob[name_start:blob.index(b"\0", name_start)].decode("ascii", errors="replace")
+            if name in found and found[name] is None:
+                found[name] = _first_string(blob[pos:pos + length])
+                if all(v is not None for v in found.values()):
+                    break
+            pos = (pos + length + 3) & ~3
+        elif token in (FDT_END_NODE, FDT_NOP):
+            continue
+        elif token == FDT_END:
+            break
+        else:
+            raise ValueError(f"Неизвестный токен FDT: {token:#x}")
+
+    return tuple(found[n] for n in names)
+
+def _read_props_dtc(blob):
+    """Запасной путь без libfdt: конвертируем DTB в текст через dtc (stdin)."""
+    cmd = ["dtc", "-I", "dtb", "-O", "dts", "-"]
+    result = subprocess.run(cmd, input=bytes(blob), capture_output=True)
+
+    if result.returncode != 0:
+        raise ValueError("dtc не смог прочитать DTB")
+
+    dts_content = result.stdout.decode("utf-8", errors="replace")
+
+    comp_match = _COMPAT_RE.search(dts_content)
+    desc_match = _DESC_RE.search(dts_content)
+    return (comp_match.group(1) if comp_match else None,
+            desc_match.group(1) if desc_match else None)
+
+def _read_props_fdtget(blob):
+    """fdtget читает только нужные свойства корня, без сериализации всего дерева в DTS."""
+    # Аргументы fdtget - пары <узел> <свойство>
+    cmd = ["fdtget", "-", "/", "compatible", "/", "description"]
+    result = subprocess.run(cmd, input=bytes(blob), capture_output=True)
+
+    lines = result.stdout.decode("utf-8", errors="replace").splitlines()
+    if result.returncode != 0 or len(lines) < 2:
+        raise ValueError("fdtget не смог прочитать свойства")
+
+    # Списки строк fdtget печатает через пробел - берем первую
+    return lines[0].split(" ", 1)[0], lines[1]
+
+def _read_props_external(blob):
+    try:
+        return _read_props_fdtget(blob)
+    except (OSError, ValueError):
+        # fdtget нет или description лежит не в корне - полный разбор через dtc
+        return _read_props_dtc(blob)
+
+# Маркер get_readable_name(external=False): блок нужно отдать fdtget/dtc
+NEEDS_EXTERNAL = object()
+
+def get_readable_name(blob, external=True):
+    """
+    Читает свойства DTB из байтов и формирует имя файла по схеме:
     Arg1(compatible) - Arg2(desc_part1) - Arg3(desc_part2)
     Пример: zuma-b0-ipop.dtb
+    С external=False внешние утилиты не запускаются: если блок не разобран
+    в процессе, возвращается NEEDS_EXTERNAL.
     """
     try:
-        # 1. Запускаем dtc для конвертации в текст
-        cmd = ["dtc", "-I", "dtb", "-O", "dts", dtb_path]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        if result.returncode != 0:
-            return None # Не удалось прочитать как DTB
-
-        dts_content = result.stdout
+        # 1. Читаем compatible и description
+        if libfdt is not None:
+            try:
+                raw_comp, raw_desc = _read_props_libfdt(blob)
+            except libfdt.FdtException:
+                return None # Не удалось прочитать как DTB
+        else:
+            try:
+                raw_comp, raw_desc = _read_props_raw(blob)
+            except (ValueError, struct.error):
+                # Не разобрали сами - отдаем внешним утилитам
+                if not external:
+                    return NEEDS_EXTERNAL
+                raw_comp, raw_desc = _read_props_external(blob)
 
-        # 2. Ищем compatible (Argument 1)
+        # 2. compatible (Argument 1)
         # Пример: compatible = "google,zuma";
         # Нам нужно "zuma"
         arg1 = "unknown"
-        comp_match = re.search(r'compatible\s*=\s*"(.*?)"', dts_content)
-        if comp_match:
-            raw_comp = comp_match.group(1)
+        if raw_comp:
             if "," in raw_comp:
                 arg1 = raw_comp.split(",")[1].strip() # берем часть после запятой
             else:
                 arg1 = raw_comp.strip()
 
-        # 3. Ищем description (Argument 2 и 3)
+        # 3. description (Argument 2 и 3)
         # Пример: description = "B0,IPOP";
+        # Примечание: берем первое вхождение. Если нужно искать строго внутри B0_IPOP,
+        # логика усложнится, но обычно description уникален для блока.
         arg2 = "unk"
         arg3 = "unk"
-        
-        # Ищем строку description. 
-        # Примечание: ищем первое вхождение. Если нужно искать строго внутри B0_IPOP,
-        # логика усложнится, но обычно description уникален для блока.
-        desc_match = re.search(r'description\s*=\s*"(.*?)"', dts_content)
-        if desc_match:
-            raw_desc = desc_match.group(1) # "B0,IPOP"
-            parts = raw_desc.split(',')
+        if raw_desc:
+            parts = raw_desc.split(',') # "B0,IPOP"
             if len(parts) >= 1:
                 arg2 = parts[0].strip().lower() # b0
             if len(parts) >= 2:
                 arg3 = parts[1].strip().lower() # ipop
-        
+
         # 4. Формируем итоговое имя
         new_name = f"{arg1}-{arg2}-{arg3}.dtb"
         return new_name
 
     except Exception as e:
-        print(f"Ошибка при парсинге {dtb_path}: {e}")
+        print(f"Ошибка при парсинге DTB: {e}")
         return None
 
+# mmap входного файла внутри процесса-воркера пула
+_WORKER_MM = None
+
+def _init_worker(path):
+    """Инициализатор воркера: один раз отображает входной файл в память."""
+    global _WORKER_MM
+    with open(path, "rb") as fp:
+        _WORKER_MM = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+def _name_span(span):
+    """Имя для блока [start, end) входного файла (выполняется в воркере)."""
+    start, end = span
+    return get_readable_name(_WORKER_MM[start:end])
+
+def find_magic(buf, magic, start=0, end=None):
+    """
+    Возвращает все смещения magic в buf (bytes или mmap).
+    Каждый следующий find() продолжает с последней находки, так что цикл -
+    это один линейный проход по буферу в C-коде поиска подстроки.
+    """
+    if end is None:
+        end = len(buf)
+    positions = []
+    pos = buf.find(magic, start, end)
+    while pos != -1:
+        positions.append(pos)
+        pos = buf.find(magic, pos + 1, end)
+    return positions
+
+def _align(value, page_size):
+    return (value + page_size - 1) // page_size * page_size
+
+def find_dtb_region(head, file_size):
+    """
+    Если файл - Android boot (header v2) или vendor_boot (v3/v4) образ, возвращает
+    (start, end) секции dtb по его заголовку, чтобы не сканировать весь образ.
+    Для остальных форматов (или при подозрительных значениях) - None.
+    """
+    region = None
+
+    if head.startswith(VENDOR_BOOT_MAGIC) and len(head) >= 2112:
+        # vendor_boot_img_hdr_v3/v4: page_size @12, vendor_ramdisk_size @24,
+        # header_size @2096, dtb_size @2100
+        page_size, = struct.unpack_from("<I", head, 12)
+        vendor_ramdisk_size, = struct.unpack_from("<I", head, 24)
+        header_size, dtb_size = struct.unpack_from("<II", head, 2096)
+        if page_size and dtb_size:
+            start = _align(header_size, page_size) + _align(vendor_ramdisk_size, page_size)
+            region = (start, start + dtb_size)
+
+    elif head.startswith(BOOT_MAGIC) and len(head) >= 1660:
+        # boot_img_hdr_v2: kernel/ramdisk/second size, page_size @36, header_version @40,
+        # recovery_dtbo_size @1632, dtb_size @1648. В v3+ dtb в boot.img нет.
+        (kernel_size, _, ramdisk_size, _, second_size, _, _,
+         page_size, header_version) = struct.unpack_from("<9I", head, 8)
+        if header_version == 2 and page_size:
+            recovery_dtbo_size, = struct.unpack_from("<I", head, 1632)
+            dtb_size, = struct.unpack_from("<I", head, 1648)
+            if dtb_size:
+                start = page_size + sum(_align(size, page_size) for size in
+                                        (kernel_size, ramdisk_size, second_size, recovery_dtbo_size))
+                region = (start, start + dtb_size)
+
+    if region and region[1] <= file_size:
+        return region
+    return None
+
 def dump_file(filename, content):
-    with open(filename, "wb") as fp:
-        fp.write(content)
+    # Без буферизации: блок уходит одним write(2), без копии в буфер Python.
+    # Сырой write может записать меньше запрошенного - дописываем остаток.
+    with open(filename, "wb", buffering=0) as fp:
+        view = memoryview(content)
+        while view:
+            view = view[fp.write(view):]
 
 def main():
     parser = argparse.ArgumentParser(description="Extract and rename DTBs from kernel image.")
@@ -79,18 +300,36 @@ def main():
         print(f"Error: Input file '{args.input}' not found.")
         sys.exit(1)
 
-    # Читаем весь файл в память
-    with open(args.input, "rb") as fp:
-        content = fp.read()
+    # mmap не умеет отображать пустой файл
+    if os.path.getsize(args.input) == 0:
+        print("No DTBs found in the input file.")
+        sys.exit(0)
+
+    # Отображаем файл в память (mmap) вместо чтения целиком:
+    # страницы подгружаются ОС по мере сканирования.
+    fp = open(args.input, "rb")
+    mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    # Смотрим на начало файла: у boot-образов смещение dtb записано в заголовке
+    head = mm[:HEAD_SIZE]
+    region = find_dtb_region(head, len(mm))
+    if region:
+        print(f"Boot image header found, scanning dtb section at {region[0]:#x} ({region[1] - region[0]} bytes).")
+        scan_start, scan_end = region
+    else:
+        known = (head.startswith((BOOT_MAGIC, VENDOR_BOOT_MAGIC))
+                 or head[0x38:0x3C] == ARM64_IMAGE_MAGIC
+                 or DTB_HEADER in head)
+        if not known:
+            print("Warning: input does not look like a boot image, kernel or DTB. Scanning the whole file anyway.")
+        scan_start, scan_end = 0, len(mm)
 
     # Ищем все смещения заголовков DTB
-    positions = []
-    dtb_next = content.find(DTB_HEADER)
-    while dtb_next != -1:
-        positions.append(dtb_next)
-        dtb_next = content.find(DTB_HEADER, dtb_next + 1)
+    positions = find_magic(mm, DTB_HEADER, scan_start, scan_end)
 
     if not positions:
+        mm.close()
+        fp.close()
         print("No DTBs found in the input file.")
         sys.exit(0)
 
@@ -102,49 +341,56 @@ def main():
     used_names = {}
 
     begin_pos = 0
-    # Проходим по позициям. Добавляем len(content) как конец последнего блока
-    loop_positions = positions + [len(content)]
+    # (a) Границы блоков: конец текущего dtb - это начало следующего, или конец области поиска
+    spans = list(zip(positions, positions[1:] + [scan_end]))
 
     # Начинаем со второго элемента (первый блок - это обычно kernel до первого dtb, или мусор)
     # Но если файл начинается сразу с DTB, логика чуть меняется.
     # Используем логику оригинального extract-dtb:
-    
-    for i in range(len(positions)):
-        start = positions[i]
-        # Конец текущего dtb - это начало следующего, или конец файла
-        end = loop_positions[i+1]
-        
-        chunk = content[start:end]
-        
-        # Временное имя
-        temp_filename = f"temp_{i:02d}.dtb"
-        temp_path = os.path.join(args.out_dir, temp_filename)
-        
-        # Сохраняем временно, чтобы dtc мог прочитать файл
-        dump_file(temp_path, chunk)
-        
-        # Пытаемся получить красивое имя
-        new_name = get_readable_name(temp_path)
-        
-        if new_name:
-            # Обработка дубликатов (если вдруг есть два одинаковых dtb)
-            if new_name in used_names:
-                used_names[new_name] += 1
-                base, ext = os.path.splitext(new_name)
-                final_name = f"{base}_{used_names[new_name]}{ext}"
-            else:
-                used_names[new_name] = 0
-                final_name = new_name
-            
-            final_path = os.path.join(args.out_dir, final_name)
-            os.rename(temp_path, final_path)
-            print(f"Extracted #{i}: {final_name}")
-        else:
-            # Если dtc не справился, оставляем базовое имя, но делаем его понятнее
-            fallback_name = f"unknown_{i:02d}.dtb"
-            final_path = os.path.join(args.out_dir, fallback_name)
-            os.rename(temp_path, final_path)
-            print(f"Extracted #{i}: {fallback_name} (parsing failed)")
+
+    # (b) Пытаемся получить красивые имена прямо из памяти. Разбор в процессе
+    # занимает микросекунды, поэтому идет последовательно.
+    names = [get_readable_name(mm[start:end], external=False) for start, end in spans]
+
+    # Блоки, которые пришлось отдать fdtget/dtc (нет pylibfdt и свой разбор не
+    # справился), стоят по запуску процесса каждый - их разбираем в пуле.
+    # В воркеры уходят только смещения - каждый воркер сам отображает входной файл.
+    pending = [i for i, name in enumerate(names) if name is NEEDS_EXTERNAL]
+    if len(pending) > 1:
+        with ProcessPoolExecutor(max_workers=min(len(pending), os.cpu_count() or 1),
+                                 initializer=_init_worker, initargs=(args.input,)) as ex:
+            external_names = list(ex.map(_name_span, [spans[i] for i in pending]))
+    else:
+        external_names = [get_readable_name(mm[spans[i][0]:spans[i][1]]) for i in pending]
+    for i, name in zip(pending, external_names):
+        names[i] = name
+
+    # (c) Сохраняем сразу под итоговым именем (без temp-файла и rename).
+    # Последовательно, чтобы used_names был детерминирован.
+    # memoryview дает срезы mmap без копирования.
+    with memoryview(mm) as mv:
+        for i, ((start, end), new_name) in enumerate(zip(spans, names)):
+            with mv[start:end] as chunk:
+                if new_name:
+                    # Обработка дубликатов (если вдруг есть два одинаковых dtb)
+                    if new_name in used_names:
+                        used_names[new_name] += 1
+                        base, ext = os.path.splitext(new_name)
+                        final_name = f"{base}_{used_names[new_name]}{ext}"
+                    else:
+                        used_names[new_name] = 0
+                        final_name = new_name
+                    
+                    dump_file(os.path.join(args.out_dir, final_name), chunk)
+                    print(f"Extracted #{i}: {final_name}")
+                else:
+                    # Если разбор не удался, оставляем базовое имя, но делаем его понятнее
+                    fallback_name = f"unknown_{i:02d}.dtb"
+                    dump_file(os.path.join(args.out_dir, fallback_name), chunk)
+                    print(f"Extracted #{i}: {fallback_name} (parsing failed)")
+
+    mm.close()
+    fp.close()
 
     print(f"\nDone! Extracted files are in: {args.out_dir}")
 
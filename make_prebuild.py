@@ -3,13 +3,17 @@
 import os
 import sys
 import argparse
+import shlex
 import shutil
 import subprocess
 import glob
+import fnmatch
 import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-import gzip # Import gzip explicitly
+import gzip # Запасной вариант для gzip_file, если нет pigz/gzip
 
 # === Цвета для вывода ===
 class Colors:
@@ -25,24 +29,47 @@ class Colors:
 DEBUG_MODE = False
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 EXTRACT_DTB_SCRIPT = os.path.join(SCRIPT_DIR, "extractdtb.py") # Предполагаемое имя скрипта из шага 1
+# Для шагов в фоновом потоке log() копит строки, а не печатает сразу
+_LOG_STATE = threading.local()
 
 # === Вспомогательные функции ===
 
+def _log_buffer():
+    """Буфер вывода текущего потока (или None, если печатаем сразу)."""
+    return getattr(_LOG_STATE, "lines", None)
+
+def emit(line):
+    """Весь вывод скрипта идет через emit: в фоновом шаге он копится в буфере."""
+    lines = _log_buffer()
+    if lines is not None:
+        lines.append(line)
+    else:
+        print(line)
+
 def log(message, color=Colors.OKBLUE):
-    print(f"{color}{message}{Colors.ENDC}")
+    emit(f"{color}{message}{Colors.ENDC}")
+
+def run_with_log_buffer(lines, func, *args):
+    """Выполняет func в текущем потоке, складывая вывод log() в lines."""
+    _LOG_STATE.lines = lines
+    try:
+        return func(*args)
+    finally:
+        _LOG_STATE.lines = None
 
 def run_cmd(command, cwd=None, shell=False, check=True):
     """Запускает команду оболочки. Вывод скрыт, если нет флага --debug."""
+    # В фоновом шаге вывод команды перехватываем всегда, чтобы он попал в буфер
+    capture = not DEBUG_MODE or _log_buffer() is not None
     try:
-        stdout_dest = subprocess.PIPE if not DEBUG_MODE else None
-        stderr_dest = subprocess.PIPE if not DEBUG_MODE else None
+        stdout_dest = subprocess.PIPE if capture else None
+        stderr_dest = subprocess.PIPE if capture else None
         
         if DEBUG_MODE:
-            print(f"{Colors.WARNING}[CMD] {command} (cwd={cwd}){Colors.ENDC}")
+            emit(f"{Colors.WARNING}[CMD] {command} (cwd={cwd}){Colors.ENDC}")
 
         # Если command передана как строка и shell=False, разбиваем её (если это не сложная команда)
         if isinstance(command, str) and not shell:
-            import shlex
             command = shlex.split(command)
 
         result = subprocess.run(
@@ -54,141 +81,250 @@ def run_cmd(command, cwd=None, shell=False, check=True):
             text=True,
             check=check
         )
+        if DEBUG_MODE and capture:
+            if result.stdout: emit(result.stdout.rstrip("\n"))
+            if result.stderr: emit(result.stderr.rstrip("\n"))
         return True
     except subprocess.CalledProcessError as e:
         # Если check=True, мы попадем сюда. 
         # Если check=False, subprocess.run не вызовет исключение, но вернет result с returncode.
         log(f"Ошибка при выполнении команды: {command}", Colors.WARNING)
-        if not DEBUG_MODE:
+        if capture:
              # Выводим ошибку, даже если debug выключен, чтобы понять причину
-            if e.stdout: print(f"STDOUT: {e.stdout}")
-            if e.stderr: print(f"STDERR: {e.stderr}")
+            if e.stdout: emit(f"STDOUT: {e.stdout}")
+            if e.stderr: emit(f"STDERR: {e.stderr}")
         return False
 
 def ensure_dir(path):
-    if not os.path.exists(path):
-        os.makedirs(path)
+    # exist_ok вместо отдельной проверки exists: один системный вызов
+    os.makedirs(path, exist_ok=True)
 
 def copy_file(src, dst):
-    """Копирует файл с обработкой исключений."""
+    """Копирует файл с обработкой исключений. Возвращает True при успехе."""
+    # shutil.copy2 на Linux (CPython 3.8+) сам копирует через sendfile, внутри ядра
     try:
-        if os.path.isdir(dst):
-            shutil.copy2(src, dst)
-        else:
-            shutil.copy2(src, dst)
+        shutil.copy2(src, dst)
         if DEBUG_MODE:
-            print(f"Copied: {src} -> {dst}")
+            emit(f"Copied: {src} -> {dst}")
+        return True
     except Exception as e:
         log(f"Ошибка копирования {src} -> {dst}: {e}", Colors.FAIL)
+        return False
 
-def find_files(directory, pattern):
-    """Рекурсивный поиск файлов."""
-    return glob.glob(os.path.join(directory, "**", pattern), recursive=True)
+def link_or_copy(src, dst):
+    """
+    Создает dst как жесткую ссылку на src (данные не копируются).
+    Если ссылку создать нельзя (другая ФС, нет поддержки) - обычное копирование.
+    """
+    try:
+        try:
+            os.unlink(dst)
+        except FileNotFoundError:
+            pass
+        os.link(src, dst)
+        if DEBUG_MODE:
+            emit(f"Linked: {src} -> {dst}")
+    except OSError:
+        copy_file(src, dst)
+
+def copy_with_link(src, dst, dst_2):
+    """
+    Копирует src в dst, а dst_2 делает жесткой ссылкой на свежую копию.
+    Если копирование в dst не удалось, dst_2 копируется из src отдельно,
+    чтобы не ссылаться на отсутствующий или устаревший файл.
+    """
+    if copy_file(src, dst):
+        link_or_copy(dst, dst_2)
+    else:
+        copy_file(src, dst_2)
+
+def gzip_file(src, dst):
+    """
+    Сжимает src в dst (gzip -9). Предпочитает pigz (многопоточный),
+    затем системный gzip; модуль gzip - только если утилит нет.
+    """
+    for tool in ("pigz", "gzip"):
+        if not shutil.which(tool):
+            continue
+        cmd = [tool, "-n", "-9", "-c"]
+        if DEBUG_MODE:
+            emit(f"{Colors.WARNING}[CMD] {' '.join(cmd)} < {src} > {dst}{Colors.ENDC}")
+        with open(src, 'rb') as f_in, open(dst, 'wb') as f_out:
+            result = subprocess.run(cmd, stdin=f_in, stdout=f_out, stderr=subprocess.PIPE, text=True)
+        if result.returncode == 0:
+            return
+        log(f"Ошибка сжатия через {tool}: {result.stderr.strip()}", Colors.WARNING)
+
+    with open(src, 'rb') as f_in:
+        with gzip.open(dst, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+
+def is_raw_kernel(path):
+    """
+    Проверяет, что файл - несжатое ядро, по магии в заголовке
+    (то же, что 'file' называет "Linux kernel ... boot executable"):
+    ARM64 Image - "ARM\\x64" по смещению 0x38,
+    ARM zImage - 0x016f2818 по смещению 0x24,
+    x86 bzImage - "HdrS" по смещению 0x202.
+    """
+    try:
+        with open(path, "rb") as f:
+            head = f.read(0x206)
+    except OSError:
+        return False
+    return (head[0x38:0x3C] == b"ARM\x64"
+            or head[0x24:0x28] == b"\x18\x28\x6f\x01"
+            or head[0x202:0x206] == b"HdrS")
+
+def decompress_kernel(src, dst):
+    """
+    Разжимает ядро через magiskboot. Выход ('-' = stdout) пишется сразу в dst,
+    без промежуточного файла. Возвращает True при успехе.
+    """
+    cmd = ["magiskboot", "decompress", src, "-"]
+    if DEBUG_MODE:
+        emit(f"{Colors.WARNING}[CMD] {' '.join(cmd)} > {dst}{Colors.ENDC}")
+    capture = not DEBUG_MODE or _log_buffer() is not None
+    try:
+        with open(dst, "wb") as f_out:
+            result = subprocess.run(cmd, stdout=f_out, stderr=subprocess.PIPE if capture else None,
+                                    text=True)
+    except OSError as e:
+        log(f"Ошибка при выполнении команды: {cmd}: {e}", Colors.WARNING)
+        return False
+    if DEBUG_MODE and capture and result.stderr:
+        emit(result.stderr.rstrip("\n"))
+    return result.returncode == 0
+
+def walk_files(directory):
+    """Один рекурсивный обход папки: список полных путей ко всем файлам."""
+    return [os.path.join(root, f) for root, _, files in os.walk(directory) for f in files]
+
+def match_files(files, pattern):
+    """Фильтрует результат walk_files по маске имени файла (без повторного обхода)."""
+    return [f for f in files if fnmatch.fnmatchcase(os.path.basename(f), pattern)]
+
+def extract_image(image_path, dest_dir):
+    """
+    Распаковывает ext4-образ в папку через debugfs (e2fsprogs) за один проход:
+    без sudo, loop-устройств и umount. Возвращает True при успехе.
+    """
+    if not shutil.which("debugfs"):
+        return False
+
+    # Команда -R разбирается парсером debugfs, который делит строку по пробелам,
+    # поэтому путь берем в кавычки. Кавычку внутри пути он экранировать не умеет.
+    if '"' in dest_dir:
+        log(f"   debugfs: путь {dest_dir} содержит кавычку, используем mount", Colors.WARNING)
+        return False
+
+    log(f"   Извлечение {os.path.basename(image_path)} через debugfs...", Colors.OKBLUE)
+    cmd = ["debugfs", "-R", f'rdump / "{dest_dir}"', image_path]
+    if DEBUG_MODE:
+        emit(f"{Colors.WARNING}[CMD] {cmd}{Colors.ENDC}")
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+    # debugfs возвращает 0 даже если образ не открылся (например, это не ext4),
+    # поэтому проверяем вывод и то, что в папке что-то появилось.
+    if result.returncode == 0 and "Filesystem not open" not in result.stderr and os.listdir(dest_dir):
+        return True
+
+    # Первая строка stderr - баннер с версией debugfs, причину ищем в остальных
+    errors = [line for line in result.stderr.splitlines()
+              if line.strip() and not line.startswith("debugfs ")]
+    reason = errors[0] if errors else f"код возврата {result.returncode}, папка пуста"
+    log(f"   debugfs не смог распаковать {os.path.basename(image_path)}: {reason}", Colors.WARNING)
+    if DEBUG_MODE:
+        emit(result.stderr)
+    shutil.rmtree(dest_dir, ignore_errors=True)
+    ensure_dir(dest_dir)
+    return False
 
 def mount_image(image_path, mount_point):
     """Монтирует образ в указанную папку (требует sudo)."""
     log(f"   Монтирование {os.path.basename(image_path)}...", Colors.OKBLUE)
     # Используем mount -o loop,ro. Требует прав суперпользователя.
-    cmd = f"sudo mount -o loop,ro {image_path} {mount_point}"
-    return run_cmd(cmd, shell=True)
+    cmd = ["sudo", "mount", "-o", "loop,ro", image_path, mount_point]
+    return run_cmd(cmd)
 
 def unmount_image(mount_point):
     """Размонтирует образ."""
     log(f"   Размонтирование {mount_point}...", Colors.OKBLUE)
-    cmd = f"sudo umount {mount_point}"
+    cmd = ["sudo", "umount", mount_point]
     # Игнорируем ошибки размонтирования, если вдруг уже размонтировано
-    subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
 
 # === Основные шаги ===
 
-def step_1_system_dlkm(tmp_dir, input_dir, out_dir):
-    log("\n[Шаг 1] Обработка system_dlkm.img", Colors.HEADER)
-    img_path = os.path.join(input_dir, "system_dlkm.img")
-    mnt_dir = os.path.join(tmp_dir, "mnt_system")
+def _collect_dlkm(src_dir, out_dir, prefix, extra_etc):
+    """Копирует из дерева *_dlkm модули (.ko), modules.blocklist, modules.load и etc/init.insmod*."""
+    # Обходим дерево один раз, дальше только фильтруем
+    all_files = walk_files(src_dir)
+
+    # 1. Найти *.ko (кроме 16k-mode)
+    ko_files = match_files(all_files, "*.ko")
+    count = 0
+    for f in ko_files:
+        if "16k-mode" not in f:
+            copy_file(f, out_dir)
+            count += 1
+    log(f"   Скопировано модулей (.ko): {count}", Colors.OKGREEN)
+
+    # 2. modules.blocklist
+    blocklists = match_files(all_files, "modules.blocklist")
+    dest_blocklist = os.path.join(out_dir, f"{prefix}.modules.blocklist")
+    if blocklists:
+        copy_file(blocklists[0], dest_blocklist)
+        log("   Найден и скопирован modules.blocklist", Colors.OKGREEN)
+    else:
+        Path(dest_blocklist).touch()
+        log("   modules.blocklist не найден. Создан пустой файл.", Colors.WARNING)
+
+    # 3. modules.load
+    loads = match_files(all_files, "modules.load")
+    dest_load = os.path.join(out_dir, f"{prefix}.modules.load")
+    if loads:
+        copy_file(loads[0], dest_load)
+        log("   Найден и скопирован modules.load", Colors.OKGREEN)
+    else:
+        log("   modules.load не найден!", Colors.FAIL)
+
+    # 4. init.insmod* в корне etc/ (не глубже)
+    if extra_etc:
+        etc_dir = os.path.join(src_dir, "etc")
+        insmods = [f for f in match_files(all_files, "init.insmod*")
+                   if os.path.dirname(f) == etc_dir]
+        for f in insmods:
+            copy_file(f, out_dir)
+        log(f"   Скопировано init.insmod файлов: {len(insmods)}", Colors.OKGREEN)
+
+def _process_dlkm(img_path, mnt_dir, out_dir, prefix, extra_etc=False):
+    """
+    Общая обработка *_dlkm.img. Образ сначала распаковывается через debugfs
+    (без sudo); если это не ext4 (например, erofs) - монтируется как раньше.
+    """
     ensure_dir(mnt_dir)
 
-    if mount_image(img_path, mnt_dir):
+    if extract_image(img_path, mnt_dir):
+        _collect_dlkm(mnt_dir, out_dir, prefix, extra_etc)
+    elif mount_image(img_path, mnt_dir):
         try:
-            # 1. Найти *.ko (кроме 16k-mode)
-            ko_files = find_files(mnt_dir, "*.ko")
-            count = 0
-            for f in ko_files:
-                if "16k-mode" not in f:
-                    copy_file(f, out_dir)
-                    count += 1
-            log(f"   Скопировано модулей (.ko): {count}", Colors.OKGREEN)
-
-            # 2. modules.blocklist
-            blocklists = find_files(mnt_dir, "modules.blocklist")
-            dest_blocklist = os.path.join(out_dir, "system_dlkm.modules.blocklist")
-            if blocklists:
-                copy_file(blocklists[0], dest_blocklist)
-                log("   Найден и скопирован modules.blocklist", Colors.OKGREEN)
-            else:
-                Path(dest_blocklist).touch()
-                log("   modules.blocklist не найден. Создан пустой файл.", Colors.WARNING)
-
-            # 3. modules.load
-            loads = find_files(mnt_dir, "modules.load")
-            dest_load = os.path.join(out_dir, "system_dlkm.modules.load")
-            if loads:
-                copy_file(loads[0], dest_load)
-                log("   Найден и скопирован modules.load", Colors.OKGREEN)
-            else:
-                 log("   modules.load не найден!", Colors.FAIL)
-
+            _collect_dlkm(mnt_dir, out_dir, prefix, extra_etc)
         finally:
             unmount_image(mnt_dir)
     else:
-        log("Не удалось примонтировать system_dlkm.img", Colors.FAIL)
+        log(f"Не удалось примонтировать {os.path.basename(img_path)}", Colors.FAIL)
+
+def step_1_system_dlkm(tmp_dir, input_dir, out_dir):
+    log("\n[Шаг 1] Обработка system_dlkm.img", Colors.HEADER)
+    _process_dlkm(os.path.join(input_dir, "system_dlkm.img"),
+                  os.path.join(tmp_dir, "mnt_system"), out_dir, prefix="system_dlkm")
 
 def step_2_vendor_dlkm(tmp_dir, input_dir, out_dir):
     log("\n[Шаг 2] Обработка vendor_dlkm.img", Colors.HEADER)
-    img_path = os.path.join(input_dir, "vendor_dlkm.img")
-    mnt_dir = os.path.join(tmp_dir, "mnt_vendor")
-    ensure_dir(mnt_dir)
-
-    if mount_image(img_path, mnt_dir):
-        try:
-            # 1. Найти *.ko (кроме 16k-mode)
-            ko_files = find_files(mnt_dir, "*.ko")
-            count = 0
-            for f in ko_files:
-                if "16k-mode" not in f:
-                    copy_file(f, out_dir)
-                    count += 1
-            log(f"   Скопировано модулей (.ko): {count}", Colors.OKGREEN)
-
-            # 2. modules.blocklist
-            blocklists = find_files(mnt_dir, "modules.blocklist")
-            dest_blocklist = os.path.join(out_dir, "vendor_dlkm.modules.blocklist")
-            if blocklists:
-                copy_file(blocklists[0], dest_blocklist)
-                log("   Найден и скопирован modules.blocklist", Colors.OKGREEN)
-            else:
-                Path(dest_blocklist).touch()
-                log("   modules.blocklist не найден. Создан пустой файл.", Colors.WARNING)
-
-            # 3. modules.load
-            loads = find_files(mnt_dir, "modules.load")
-            dest_load = os.path.join(out_dir, "vendor_dlkm.modules.load")
-            if loads:
-                copy_file(loads[0], dest_load)
-                log("   Найден и скопирован modules.load", Colors.OKGREEN)
-
-            # 4. init.insmod* в корне etc/ (не глубже)
-            etc_dir = os.path.join(mnt_dir, "etc")
-            if os.path.exists(etc_dir):
-                # glob не рекурсивно
-                insmods = glob.glob(os.path.join(etc_dir, "init.insmod*"))
-                for f in insmods:
-                    copy_file(f, out_dir)
-                log(f"   Скопировано init.insmod файлов: {len(insmods)}", Colors.OKGREEN)
-
-        finally:
-            unmount_image(mnt_dir)
-    else:
-        log("Не удалось примонтировать vendor_dlkm.img", Colors.FAIL)
+    _process_dlkm(os.path.join(input_dir, "vendor_dlkm.img"),
+                  os.path.join(tmp_dir, "mnt_vendor"), out_dir, prefix="vendor_dlkm",
+                  extra_etc=True)
 
 def step_3_vendor_kernel_boot(tmp_dir, input_dir, out_dir):
     log("\n[Шаг 3] Обработка vendor_kernel_boot.img", Colors.HEADER)
@@ -205,10 +341,10 @@ def step_3_vendor_kernel_boot(tmp_dir, input_dir, out_dir):
     log("   Распаковка образа через magiskboot...", Colors.OKBLUE)
     # magiskboot может вернуть ошибку на некоторых форматах, но распаковать ramdisk. 
     # Ставим check=False и проверяем результат вручную.
-    run_cmd("magiskboot unpack vendor_kernel_boot.img", cwd=work_dir, check=False)
+    run_cmd(["magiskboot", "unpack", "vendor_kernel_boot.img"], cwd=work_dir, check=False)
     
     # Извлечение cpio
-    cpio_files = find_files(work_dir, "*.cpio")
+    cpio_files = match_files(walk_files(work_dir), "*.cpio")
     if cpio_files:
         # Используем полный путь к найденному CPIO, так как он может быть в подпапке
         cpio_path = cpio_files[0]
@@ -217,10 +353,13 @@ def step_3_vendor_kernel_boot(tmp_dir, input_dir, out_dir):
         
         # Извлекаем CPIO. Используем полный путь к cpio, cwd остается work_dir, 
         # чтобы файлы извлекались в корень рабочей папки.
-        run_cmd(f"magiskboot cpio {cpio_path} extract", cwd=work_dir)
+        run_cmd(["magiskboot", "cpio", cpio_path, "extract"], cwd=work_dir)
         
+        # Обходим распакованное дерево один раз, дальше только фильтруем
+        all_files = walk_files(work_dir)
+
         # 1. Найти *.ko
-        ko_files = find_files(work_dir, "*.ko")
+        ko_files = match_files(all_files, "*.ko")
         count = 0
         for f in ko_files:
             if "16k-mode" not in f:
@@ -233,7 +372,7 @@ def step_3_vendor_kernel_boot(tmp_dir, input_dir, out_dir):
             log(f"   Скопировано модулей (.ko): {count}", Colors.OKGREEN)
         
         # 2. modules.blocklist
-        blocklists = find_files(work_dir, "modules.blocklist")
+        blocklists = match_files(all_files, "modules.blocklist")
         dest_blocklist = os.path.join(out_dir, "vendor_kernel_boot.modules.blocklist")
         if blocklists:
             copy_file(blocklists[0], dest_blocklist)
@@ -243,12 +382,11 @@ def step_3_vendor_kernel_boot(tmp_dir, input_dir, out_dir):
             log("   modules.blocklist не найден. Создан пустой файл.", Colors.WARNING)
             
         # 3. modules.load -> modules.load
-        loads = find_files(work_dir, "modules.load")
+        loads = match_files(all_files, "modules.load")
         dest_load = os.path.join(out_dir, "modules.load")
         dest_load_2 = os.path.join(out_dir, "vendor_kernel_boot.modules.load")
         if loads:
-            copy_file(loads[0], dest_load)
-            copy_file(loads[0], dest_load_2)
+            copy_with_link(loads[0], dest_load, dest_load_2)
             log("   Найден и скопирован modules.load и vendor_kernel_boot.modules.load", Colors.OKGREEN)
     else:
         log("   CPIO файл не найден внутри vendor_kernel_boot.img (возможно, ошибка распаковки)", Colors.FAIL)
@@ -288,8 +426,7 @@ def step_3_1_process_dtb(vkb_work_dir, out_dir):
     log(f"   Всего DTB файлов в выходной папке: {len(final_dtbs)}", Colors.OKGREEN)
     
     # Копируем исходный dtb как dtb.img и dtb
-    copy_file(dtb_src, os.path.join(out_dir, "dtb.img"))
-    copy_file(dtb_src, os.path.join(out_dir, "dtb"))
+    copy_with_link(dtb_src, os.path.join(out_dir, "dtb.img"), os.path.join(out_dir, "dtb"))
     
     return final_dtbs
 
@@ -302,7 +439,7 @@ def step_4_boot_img(tmp_dir, input_dir, out_dir):
     copy_file(src_boot, work_dir)
     
     log("   Распаковка boot.img...", Colors.OKBLUE)
-    run_cmd("magiskboot unpack boot.img", cwd=work_dir)
+    run_cmd(["magiskboot", "unpack", "boot.img"], cwd=work_dir)
     
     # Ищем kernel
     if os.path.exists(os.path.join(work_dir, "kernel")):
@@ -314,15 +451,12 @@ def step_4_boot_img(tmp_dir, input_dir, out_dir):
         # Сжимаем lz4
         log("   Сжатие kernel в Image.lz4...", Colors.OKBLUE)
         # ВАЖНО: out_dir теперь абсолютный путь, поэтому ошибки "No such file" не будет
-        run_cmd(f"magiskboot compress=lz4_legacy kernel {os.path.join(out_dir, 'Image.lz4')}", cwd=work_dir)
+        run_cmd(["magiskboot", "compress=lz4_legacy", "kernel", os.path.join(out_dir, "Image.lz4")], cwd=work_dir)
         
         # Сжимаем gz
         log("   Сжатие kernel в Image.gz...", Colors.OKBLUE)
         
-        # Используем модуль gzip, удалив старый код с os.popen
-        with open(os.path.join(work_dir, "kernel"), 'rb') as f_in:
-            with gzip.open(os.path.join(out_dir, "Image.gz"), 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
+        gzip_file(os.path.join(work_dir, "kernel"), os.path.join(out_dir, "Image.gz"))
                 
     else:
         log("   Файл kernel не найден в boot.img!", Colors.FAIL)
@@ -347,7 +481,7 @@ def step_5_custom_kernel(tmp_dir, input_dir, out_dir, img_arg, dtb_created_files
         log(f"   Обработка ZIP архива: {img_arg}", Colors.OKBLUE)
         zip_extract_dir = os.path.join(tmp_dir, "zip_extract")
         ensure_dir(zip_extract_dir)
-        run_cmd(f"unzip -o {img_arg} -d {zip_extract_dir}")
+        run_cmd(["unzip", "-o", img_arg, "-d", zip_extract_dir])
         
         # Поиск ядра (Image, kernel, zImage)
         candidates = ["Image", "kernel", "zImage", "Image.gz", "Image.lz4"]
@@ -365,22 +499,13 @@ def step_5_custom_kernel(tmp_dir, input_dir, out_dir, img_arg, dtb_created_files
             log(f"   Найдено ядро в ZIP: {found_kernel}", Colors.OKGREEN)
             decompressed_kernel = os.path.join(repacker_dir, "kernel")
             
-            # Проверка типа файла через 'file'
-            is_raw = False
-            try:
-                res = subprocess.run(["file", found_kernel], capture_output=True, text=True)
-                # Raw Image обычно содержит "Linux kernel ... boot executable"
-                if "boot executable" in res.stdout and "Linux kernel" in res.stdout:
-                    is_raw = True
-            except Exception:
-                pass
-
-            if is_raw:
+            # Проверка типа файла по заголовку
+            if is_raw_kernel(found_kernel):
                 log("   Определен формат RAW Image. Копируем...", Colors.OKBLUE)
                 copy_file(found_kernel, decompressed_kernel)
             else:
                 # Пытаемся разжать
-                if not run_cmd(f"magiskboot decompress {found_kernel} {decompressed_kernel}", check=False):
+                if not decompress_kernel(found_kernel, decompressed_kernel):
                     log("   Не удалось разжать (возможно, raw format). Копируем как есть...", Colors.WARNING)
                     copy_file(found_kernel, decompressed_kernel)
             
@@ -405,15 +530,16 @@ def step_5_custom_kernel(tmp_dir, input_dir, out_dir, img_arg, dtb_created_files
             if dtb_created_files:
                 log(f"   Удаление старых DTB файлов ({len(dtb_created_files)} шт)...", Colors.OKBLUE)
                 for f in dtb_created_files:
-                    f_path = os.path.join(out_dir, f)
-                    if os.path.exists(f_path):
-                        os.remove(f_path)
+                    # unlink сразу, без предварительного exists: один вызов на файл
+                    try:
+                        os.unlink(os.path.join(out_dir, f))
+                    except FileNotFoundError:
+                        pass
             else:
                 log("   Старых DTB файлов для удаления не найдено.", Colors.WARNING)
             
             # Копируем новый
-            copy_file(found_dtb, os.path.join(out_dir, "dtb.img"))
-            copy_file(found_dtb, os.path.join(out_dir, "dtb"))
+            copy_with_link(found_dtb, os.path.join(out_dir, "dtb.img"), os.path.join(out_dir, "dtb"))
             
             # Запускаем extractdtb снова
             cmd = [sys.executable, EXTRACT_DTB_SCRIPT, "--input", found_dtb, "--out-dir", out_dir]
@@ -425,21 +551,13 @@ def step_5_custom_kernel(tmp_dir, input_dir, out_dir, img_arg, dtb_created_files
         log(f"   Обработка файла образа: {img_arg}", Colors.OKBLUE)
         decompressed_kernel = os.path.join(repacker_dir, "kernel")
         
-        # Проверка типа файла через 'file'
-        is_raw = False
-        try:
-            res = subprocess.run(["file", img_arg], capture_output=True, text=True)
-            if "boot executable" in res.stdout and "Linux kernel" in res.stdout:
-                is_raw = True
-        except Exception:
-            pass
-
-        if is_raw:
+        # Проверка типа файла по заголовку
+        if is_raw_kernel(img_arg):
              log("   Определен формат RAW Image. Копируем...", Colors.OKBLUE)
              copy_file(img_arg, decompressed_kernel)
         else:
             # Пытаемся разжать. Если не выходит (например, формат raw), копируем как есть.
-            if not run_cmd(f"magiskboot decompress {img_arg} {decompressed_kernel}", check=False):
+            if not decompress_kernel(img_arg, decompressed_kernel):
                 log("   Не удалось разжать (возможно, raw format). Копируем как есть...", Colors.WARNING)
                 copy_file(img_arg, decompressed_kernel)
             
@@ -449,7 +567,7 @@ def step_5_custom_kernel(tmp_dir, input_dir, out_dir, img_arg, dtb_created_files
     if kernel_source and os.path.exists(os.path.join(repacker_dir, "kernel")):
         log("   Пересборка boot.img с новым ядром...", Colors.OKBLUE)
         # magiskboot repack <boot.img> (он берет kernel из текущей папки repacker)
-        run_cmd(f"magiskboot repack boot.img", cwd=repacker_dir)
+        run_cmd(["magiskboot", "repack", "boot.img"], cwd=repacker_dir)
         
         new_boot = os.path.join(repacker_dir, "new-boot.img")
         if os.path.exists(new_boot):
@@ -459,12 +577,9 @@ def step_5_custom_kernel(tmp_dir, input_dir, out_dir, img_arg, dtb_created_files
             
             # Обновляем Image файлы в out
             copy_file(os.path.join(repacker_dir, "kernel"), os.path.join(out_dir, "Image"))
-            run_cmd(f"magiskboot compress=lz4_legacy kernel {os.path.join(out_dir, 'Image.lz4')}", cwd=repacker_dir)
+            run_cmd(["magiskboot", "compress=lz4_legacy", "kernel", os.path.join(out_dir, "Image.lz4")], cwd=repacker_dir)
             
-            import gzip
-            with open(os.path.join(repacker_dir, "kernel"), 'rb') as f_in:
-                with gzip.open(os.path.join(out_dir, "Image.gz"), 'wb') as f_out:
-                    shutil.copyfileobj(f_in, f_out)
+            gzip_file(os.path.join(repacker_dir, "kernel"), os.path.join(out_dir, "Image.gz"))
             log("   Выходные файлы Image/boot.img обновлены.", Colors.OKGREEN)
         else:
             log("   Ошибка: new-boot.img не был создан.", Colors.FAIL)
@@ -513,8 +628,7 @@ def main():
     # Копируем dtbo.img сразу (он не требует обработки по ТЗ, но должен быть проверен)
     # Копируем его как dtbo и как dtbo.img без обработки
     src_dtbo = os.path.join(args.input, "dtbo.img")
-    copy_file(src_dtbo, os.path.join(args.out, "dtbo.img"))
-    copy_file(src_dtbo, os.path.join(args.out, "dtbo"))
+    copy_with_link(src_dtbo, os.path.join(args.out, "dtbo.img"), os.path.join(args.out, "dtbo"))
     log("   Скопирован dtbo.img (как dtbo и dtbo.img)", Colors.OKGREEN)
 
     # Создаем временную директорию
@@ -522,20 +636,36 @@ def main():
         log(f"Временная папка: {tmp_dir}", Colors.HEADER)
         
         try:
-            # Шаг 1
-            step_1_system_dlkm(tmp_dir, args.input, args.out)
-            
-            # Шаг 2
-            step_2_vendor_dlkm(tmp_dir, args.input, args.out)
-            
-            # Шаг 3 (возвращает папку, где лежит распакованный dtb)
-            vkb_extract_dir = step_3_vendor_kernel_boot(tmp_dir, args.input, args.out)
-            
-            # Шаг 3.1 (возвращает список созданных файлов)
-            dtb_files = step_3_1_process_dtb(vkb_extract_dir, args.out)
-            
-            # Шаг 4
-            step_4_boot_img(tmp_dir, args.input, args.out)
+            # Шаги 1-3 копируют *.ko в одну и ту же out-папку, поэтому идут
+            # последовательно: при совпадении имен модулей побеждает vendor_kernel_boot.
+            # Шаг 4 пишет только свои файлы (Image*, boot.img) и в основном ждет
+            # magiskboot и сжатие, поэтому выполняется в потоке параллельно.
+            # Его вывод копится и печатается после шага 3.1, чтобы не перемешивался.
+            step_4_log = []
+            with ThreadPoolExecutor(max_workers=1) as ex:
+                # Шаг 4
+                f4 = ex.submit(run_with_log_buffer, step_4_log,
+                               step_4_boot_img, tmp_dir, args.input, args.out)
+                
+                try:
+                    # Шаг 1
+                    step_1_system_dlkm(tmp_dir, args.input, args.out)
+                    
+                    # Шаг 2
+                    step_2_vendor_dlkm(tmp_dir, args.input, args.out)
+                    
+                    # Шаг 3 (возвращает папку, где лежит распакованный dtb)
+                    vkb_extract_dir = step_3_vendor_kernel_boot(tmp_dir, args.input, args.out)
+                    
+                    # Шаг 3.1 (возвращает список созданных файлов)
+                    dtb_files = step_3_1_process_dtb(vkb_extract_dir, args.out)
+                finally:
+                    # Дожидаемся шага 4 (исключения пробрасываются сюда) и выводим его лог
+                    try:
+                        f4.result()
+                    finally:
+                        for line in step_4_log:
+                            print(line)
             
             # Шаг 5 (Опционально)
             if args.img: